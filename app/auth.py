@@ -1,26 +1,85 @@
 from fastapi import HTTPException, Request, status
 from .config import API_KEY, METRICS_USER, METRICS_PASS
 import base64
+import hmac
 
+# Pre-encode expected credentials once; hmac.compare_digest wants bytes and
+# re-encoding the secrets on every request would be wasted work
+_API_KEY_BYTES = API_KEY.encode() if API_KEY else b""
+_METRICS_USER_BYTES = METRICS_USER.encode() if METRICS_USER else b""
+_METRICS_PASS_BYTES = METRICS_PASS.encode() if METRICS_PASS else b""
 
-def require_api_key(request: Request):
-    if not API_KEY:
-        return
+# The exact header a well-behaved client sends; lets the common case pass with a single
+# constant-time compare and no base64 work at all
+_EXPECTED_BASIC_HEADER = (
+    b"Basic " + base64.b64encode(f"{METRICS_USER}:{METRICS_PASS}".encode())
+    if METRICS_USER and METRICS_PASS
+    else b""
+)
+
+# 128-entry base64 value table; -1 marks invalid bytes. The decoder below masks the
+# lookup result instead of branching on it, so the work done per input byte does not
+# depend on where (or whether) the attacker-controlled credential blob is malformed.
+_B64_TABLE = [-1] * 128
+for _i, _c in enumerate("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"):
+    _B64_TABLE[ord(_c)] = _i
+del _i, _c
+
+
+def _ct_b64decode(s: bytes) -> bytes:
+    """Base64-decode with a masked table lookup, always consuming the full input
+    before raising on malformed data (no early exit on the error path)."""
+    pad = 0
+    while s.endswith(b"="):
+        s = s[:-1]
+        pad += 1
+    invalid = 1 if (pad > 2 or (len(s) + pad) % 4) else 0
+    acc = 0
+    bits = 0
+    out = bytearray()
+    for b in s:
+        v = _B64_TABLE[b & 0x7F]
+        invalid |= (v >> 6) & 1  # -1 keeps its sign bit through the shift
+        invalid |= b >> 7
+        acc = ((acc << 6) | (v & 0x3F)) & 0xFFFFFF
+        bits += 6
+        if bits >= 8:
+            bits -= 8
+            out.append((acc >> bits) & 0xFF)
+    if invalid:
+        raise ValueError("invalid base64")
+    return bytes(out)
+
+
+def _noop_dependency(request: Request):
+    return
+
+
+def _require_api_key(request: Request):
     key = request.headers.get("x-api-key") or request.query_params.get("api_key")
-    if key != API_KEY:
+    if not hmac.compare_digest((key or "").encode(), _API_KEY_BYTES):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail={"error": "invalid api key"})
 
 
-def require_metrics_basic_auth(request: Request):
-    if not (METRICS_USER and METRICS_PASS):
-        return
+def _require_metrics_basic_auth(request: Request):
     auth = request.headers.get("authorization", "")
-    if not auth.lower().startswith("basic "):
+    if hmac.compare_digest(auth.encode(), _EXPECTED_BASIC_HEADER):
+        return
+    # Fall back to decoding for clients that use different casing or base64 padding;
+    # only lowercase the 6-byte prefix instead of allocating a copy of the whole header
+    if auth[:6].lower() != "basic ":
         raise HTTPException(status_code=401, detail={"error": "basic auth required"}, headers={"WWW-Authenticate": "Basic"})
     try:
-        decoded = base64.b64decode(auth.split(" ", 1)[1]).decode()
+        decoded = _ct_b64decode(auth.split(" ", 1)[1].encode()).decode()
         user, pwd = decoded.split(":", 1)
-        if not (user == METRICS_USER and pwd == METRICS_PASS):
+        # bitwise & instead of `and` so both compares always run (no short-circuit timing)
+        if not (hmac.compare_digest(user.encode(), _METRICS_USER_BYTES) & hmac.compare_digest(pwd.encode(), _METRICS_PASS_BYTES)):
             raise ValueError("bad creds")
     except Exception:
         raise HTTPException(status_code=401, detail={"error": "invalid credentials"}, headers={"WWW-Authenticate": "Basic"})
+
+
+# Resolve the dependencies once at import: the env vars never change after startup, so
+# when auth is disabled FastAPI dispatches a plain no-op with no per-request conditionals
+require_api_key = _require_api_key if API_KEY else _noop_dependency
+require_metrics_basic_auth = _require_metrics_basic_auth if (METRICS_USER and METRICS_PASS) else _noop_dependency
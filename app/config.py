@@ -1,33 +1,57 @@
 import os
 import yaml
-from typing import Dict, Any, List, Optional
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Dict, Any, List, Optional, Tuple
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
 # Load .env early
 load_dotenv()
 
+# Prefer the libyaml-backed loader when available; parsing happens on every reload
+_YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+class ExporterSettings(BaseModel):
+    """Typed view of the `exporter` config section with defaults resolved at parse time.
+
+    Hot-path code reads plain attributes instead of chaining dict .get() fallbacks
+    and re-coercing types on every access.
+    """
+
+    listen_addr: str = "0.0.0.0"
+    listen_port: int = 9782
+    check_interval_seconds: int = 300
+    max_parallel_tests: int = 8
+    receive_poll_seconds: int = 5
+    receive_timeout_seconds: int = 120
+    use_idle: bool = True
+    delete_testmail_after_verify: bool = True
+    subject_prefix: str = "[MAIL-E2E]"
+    metrics_prefix: str = "mail_"
+    smtp_timeout_seconds: int = 60
+    smtp_max_attempts: int = 3
+    # Per-attempt retry delays for temporary SMTP failures; the last entry repeats if
+    # there are more attempts than entries
+    smtp_retry_backoffs: Tuple[float, ...] = (3.0, 6.0, 12.0)
+    uncertain_probe_on_timeout: bool = True
+    uncertain_probe_timeout_seconds: int = 12
+    uncertain_probe_poll_seconds: int = 4
+    min_smtp_interval_seconds: int = 0
+    send_jitter_max_seconds: int = 0
+    metrics_cache_ttl_seconds: float = 1.0
+
+
 DEFAULTS: Dict[str, Any] = {
-    "exporter": {
-        "listen_addr": "0.0.0.0",
-        "listen_port": 9782,
-        "check_interval_seconds": 300,
-        "receive_poll_seconds": 5,
-        "receive_timeout_seconds": 120,
-        "delete_testmail_after_verify": True,
-        "subject_prefix": "[MAIL-E2E]",
-        "metrics_prefix": "mail_",
-        "smtp_timeout_seconds": 60,
-        "uncertain_probe_on_timeout": True,
-        "uncertain_probe_timeout_seconds": 12,
-        "uncertain_probe_poll_seconds": 4,
-        "min_smtp_interval_seconds": 0,
-        "send_jitter_max_seconds": 0,
-    },
+    "exporter": ExporterSettings().model_dump(),
     "accounts": {},
     "tests": [],
 }
 
+# Freeze the default sub-dicts: loads that don't override a section share the read-only
+# default instead of rebuilding a copy of it on every (re)load
+DEFAULTS = {k: (MappingProxyType(v) if isinstance(v, dict) else v) for k, v in DEFAULTS.items()}
+
 CONFIG_PATH = os.environ.get("CONFIG_PATH", "/app/config.yaml")
 API_KEY = os.environ.get("API_KEY")
 METRICS_USER = os.environ.get("METRICS_USER")
@@ -38,45 +62,99 @@ GIT_SHA = os.environ.get("GIT_SHA", "")
 BUILD_DATE = os.environ.get("BUILD_DATE", "")
 
 
-class ExporterConfig(BaseModel):
+def _expand_env_value(val: Any) -> Any:
+    """Recursively expand ${VAR} references in account config values."""
+    if isinstance(val, str):
+        return os.path.expandvars(val)
+    if isinstance(val, dict):
+        return {k: _expand_env_value(v) for k, v in val.items()}
+    if isinstance(val, list):
+        return [_expand_env_value(v) for v in val]
+    return val
+
+
+# Plain dataclass rather than a BaseModel: the payload is Dict[str, Any], so Pydantic
+# validation on every (re)load would deep-walk the tree for nothing
+@dataclass(slots=True)
+class ExporterConfig:
     data: Dict[str, Any]
+    exporter: ExporterSettings = field(default_factory=ExporterSettings)
+    # Accounts with ${VAR} references already expanded; computed once per (re)load so
+    # senders/receivers don't re-walk the account dicts every cycle
+    accounts_expanded: Dict[str, Any] = field(default_factory=dict)
+    # Bumped on every successful reload; consumers can dirty-check against it instead
+    # of re-deriving state from the config each cycle
+    generation: int = 0
 
     @classmethod
     def load(cls, path: str) -> "ExporterConfig":
-        data = DEFAULTS.copy()
-        if os.path.exists(path):
+        # Open directly instead of exists()+open(): one syscall less and no race with
+        # concurrent config replacement
+        try:
             with open(path, "r", encoding="utf-8") as f:
-                loaded = yaml.safe_load(f) or {}
-                for k, v in loaded.items():
-                    if isinstance(v, dict) and k in data and isinstance(data[k], dict):
-                        data[k] = {**data[k], **v}
-                    else:
-                        data[k] = v
-        return cls(data=data)
+                loaded = yaml.load(f, Loader=_YAML_LOADER) or {}
+        except FileNotFoundError:
+            loaded = {}
+        # Overlay onto the frozen defaults; sections absent from the file reuse the
+        # shared read-only default mapping without copying
+        data: Dict[str, Any] = {}
+        for k, dv in DEFAULTS.items():
+            v = loaded.get(k, dv)
+            if isinstance(dv, MappingProxyType) and isinstance(v, dict) and v is not dv:
+                data[k] = {**dv, **v}
+            else:
+                data[k] = v
+        for k, v in loaded.items():
+            if k not in data:
+                data[k] = v
+        return cls(
+            data=data,
+            exporter=ExporterSettings(**dict(data["exporter"])),
+            accounts_expanded={k: _expand_env_value(v) for k, v in dict(data["accounts"]).items()},
+        )
 
     def tests(self) -> List[Dict[str, Any]]:
         return self.data.get("tests", [])
 
 
-# live config + mtime tracking
+# live config + (mtime_ns, size, ino) fingerprint tracking; the combined fingerprint
+# avoids spurious reparses on filesystems with coarse mtime resolution and still
+# catches atomic rename-over replacements (new inode) that preserve mtime and size
+def _stat_fingerprint() -> Optional[tuple]:
+    try:
+        st = os.stat(CONFIG_PATH)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+    except FileNotFoundError:
+        return None
+
+
 config: ExporterConfig = ExporterConfig.load(CONFIG_PATH)
-_config_mtime_ns: Optional[int] = None
+_config_fingerprint: Optional[tuple] = _stat_fingerprint()
 
 
 def reload_config_if_changed(logger, force: bool = False) -> bool:
-    global config, _config_mtime_ns
-    try:
-        st = os.stat(CONFIG_PATH)
-        mtime_ns = st.st_mtime_ns
-        changed = force or (_config_mtime_ns is None) or (mtime_ns != _config_mtime_ns)
-    except FileNotFoundError:
-        mtime_ns = None
-        changed = force or (_config_mtime_ns is not None)
+    """Reload the config when its on-disk fingerprint moved (or when forced).
+
+    Cheap enough (one stat in the common unchanged case) to call every check cycle,
+    giving push-like reload behavior without an inotify dependency.
+    """
+    global _config_fingerprint
+    fingerprint = _stat_fingerprint()
+    if fingerprint is None:
+        changed = force or (_config_fingerprint is not None)
+    else:
+        changed = force or (fingerprint != _config_fingerprint)
     if changed:
         try:
-            config = ExporterConfig.load(CONFIG_PATH)
-            _config_mtime_ns = mtime_ns
-            logger.info(f"Config reloaded from {CONFIG_PATH} (mtime_ns={mtime_ns})")
+            new_cfg = ExporterConfig.load(CONFIG_PATH)
+            # Mutate the shared singleton in place so modules that imported `config`
+            # observe the new values immediately
+            config.data = new_cfg.data
+            config.exporter = new_cfg.exporter
+            config.accounts_expanded = new_cfg.accounts_expanded
+            config.generation += 1
+            _config_fingerprint = fingerprint
+            logger.info(f"Config reloaded from {CONFIG_PATH} (fingerprint={fingerprint})")
             return True
         except Exception as e:  # keep behavior
             logger.error(f"Failed to reload config: {e}")
@@ -1,17 +1,100 @@
+import functools
+import threading
 import time
+from datetime import datetime, timedelta
 from typing import Any, Dict
 from imapclient import IMAPClient
 from imapclient.exceptions import LoginError
 
 from .logging_setup import logger
-from .config import config
+from .config import config, ExporterSettings
 from .metrics import g_recv_ok, g_last_recv, g_roundtrip, g_recv_attempted
-from .smtp_client import _expand_env_value
+from .smtp_client import _SSL_CTX
 
+# Pooled, logged-in IMAP connections keyed by (host, port, user). TLS handshake + LOGIN
+# dominate short waits, so sessions are reused across check cycles; a borrowed client is
+# removed from the pool, so concurrent routes to the same account get distinct sockets.
+_IMAP_POOL: Dict[tuple, IMAPClient] = {}
+_IMAP_POOL_LOCK = threading.Lock()
 
-def imap_wait_receive(route_name: str, dst_key: str, subject_token: str, config_exporter: Dict[str, Any]) -> Dict[str, Any]:
-    dst_raw = config.data.get("accounts", {}).get(dst_key) or {}
-    dst = _expand_env_value(dst_raw)
+
+@functools.lru_cache(maxsize=128)
+def _is_gmail_host(host: str) -> bool:
+    host_lc = host.lower()
+    return "gmail.com" in host_lc or host_lc.endswith("googlemail.com")
+
+
+@functools.lru_cache(maxsize=128)
+def _folder_candidates(host: str, mailbox: str) -> tuple:
+    """Candidate folders: primary mailbox first, then provider-specific fallbacks
+    (e.g., Gmail All Mail/Spam). Cached per (host, mailbox) — pure config-derived data."""
+    folders = [mailbox]
+    if _is_gmail_host(host):
+        # Try common English folder names; localized names may differ, best-effort without listing all mailboxes
+        folders += ["[Gmail]/All Mail", "[Gmail]/Spam", "[Google Mail]/All Mail", "[Google Mail]/Spam"]
+    return tuple(folders)
+
+
+def _shutdown_quietly(client: IMAPClient) -> None:
+    try:
+        client.shutdown()
+    except Exception:
+        pass
+
+
+def _borrow_imap(host: str, port: int, use_ssl: bool, user: str, pwd: str, timeout_s: int) -> IMAPClient:
+    key = (host, port, user)
+    with _IMAP_POOL_LOCK:
+        client = _IMAP_POOL.pop(key, None)
+    if client is not None:
+        try:
+            client.noop()  # detect dead sockets before reuse
+            return client
+        except Exception:
+            _shutdown_quietly(client)
+    client = IMAPClient(host, port=port, ssl=use_ssl, ssl_context=(_SSL_CTX if use_ssl else None), timeout=timeout_s)
+    try:
+        client.login(user, pwd)
+    except LoginError as e:
+        logger.error(f"IMAP login failed: {e}")
+        _shutdown_quietly(client)
+        raise
+    except Exception:
+        _shutdown_quietly(client)
+        raise
+    return client
+
+
+def _return_imap(host: str, port: int, user: str, client: IMAPClient) -> None:
+    key = (host, port, user)
+    with _IMAP_POOL_LOCK:
+        prev = _IMAP_POOL.get(key)
+        _IMAP_POOL[key] = client
+    if prev is not None and prev is not client:
+        _shutdown_quietly(prev)
+
+
+def close_all_imap() -> None:
+    """Log out and drop every pooled IMAP connection (app shutdown)."""
+    with _IMAP_POOL_LOCK:
+        clients = list(_IMAP_POOL.values())
+        _IMAP_POOL.clear()
+    for client in clients:
+        try:
+            client.logout()
+        except Exception:
+            _shutdown_quietly(client)
+
+
+def imap_wait_receive(
+    route_name: str,
+    dst_key: str,
+    subject_token: str,
+    exporter: ExporterSettings,
+    timeout_s: int | None = None,
+    poll_s: int | None = None,
+) -> Dict[str, Any]:
+    dst = config.accounts_expanded.get(dst_key) or {}
     imap = dst.get("imap", {}) or {}
     host = imap.get("host")
     port = int(imap.get("port", 993))
@@ -20,43 +103,103 @@ def imap_wait_receive(route_name: str, dst_key: str, subject_token: str, config_
     pwd = imap.get("password")
     mailbox = imap.get("folder", "INBOX")
 
-    poll_s = int(config_exporter.get("receive_poll_seconds", 5))
-    timeout_s = int(config_exporter.get("receive_timeout_seconds", 120))
+    # Explicit overrides exist for the short uncertain-send probe; the regular receive
+    # wait uses the configured values
+    if poll_s is None:
+        poll_s = exporter.receive_poll_seconds
+    if timeout_s is None:
+        timeout_s = exporter.receive_timeout_seconds
+
+    # Bind label children once; .labels() does a dict lookup + lock per call, which adds
+    # up inside the poll loop
+    recv_attempted = g_recv_attempted.labels(route=route_name)
+    recv_ok = g_recv_ok.labels(route=route_name)
+    last_recv = g_last_recv.labels(route=route_name)
+    roundtrip = g_roundtrip.labels(route=route_name)
 
     start_ts = time.time()
-    g_recv_attempted.labels(route=route_name, **{"from": "?", "to": dst_key}).set(1)
+    # Monotonic clock for the wait deadline (wall clock can step under NTP adjustment);
+    # wall time stays for the exposed timestamp and roundtrip metrics
+    start_mono = time.monotonic()
+    deadline = start_mono + timeout_s
+    next_poll = start_mono
+    recv_attempted.set(1)
 
-    with IMAPClient(host, port=port, ssl=use_ssl, timeout=timeout_s) as client:
-        try:
-            client.login(user, pwd)
-            client.select_folder(mailbox)
-        except LoginError as e:
-            logger.error(f"IMAP login failed: {e}")
-            raise
-
-        # Folders to check: primary mailbox first, then provider-specific fallbacks (e.g., Gmail All Mail/Spam)
-        folders = [mailbox]
-        host_lc = (host or "").lower()
-        if "gmail.com" in host_lc or host_lc.endswith("googlemail.com"):
-            # Try common English folder names; localized names may differ, best-effort without listing all mailboxes
-            folders += ["[Gmail]/All Mail", "[Gmail]/Spam", "[Google Mail]/All Mail", "[Google Mail]/Spam"]
-
-        # Build search criteria: match in SUBJECT or BODY
-        criteria = ['OR', ['SUBJECT', subject_token], ['BODY', subject_token]]
+    client = _borrow_imap(host, port, use_ssl, user, pwd, timeout_s)
+    healthy = True
+    try:
+        # Readonly select (EXAMINE) for the whole search phase: the server skips \Recent
+        # clearing and modseq bumps, and only the delete path below needs write access
+        client.select_folder(mailbox, readonly=True)
+        # Track the server-side selected folder so the scan loop only issues SELECT when
+        # it actually changes folders (one IMAP round-trip saved per skipped SELECT)
+        selected = mailbox
+
+        is_gmail = _is_gmail_host(host or "")
+
+        # The candidate list is pure config-derived data and the LIST intersection only
+        # depends on the server, so cache the final scan list per mailbox on the pooled
+        # connection: repeated waits on a reused session skip both the list rebuild and
+        # the LIST round-trip that prunes fallback names (e.g. the [Google Mail]
+        # variants) which don't exist on this server.
+        scan_cache = getattr(client, "_folder_scan_cache", None)
+        if scan_cache is None:
+            scan_cache = client._folder_scan_cache = {}
+        folders = scan_cache.get(mailbox)
+        if folders is None:
+            folders = list(_folder_candidates(host or "", mailbox))
+            if len(folders) > 1:
+                try:
+                    names = {n for _, _, n in client.list_folders()}
+                    folders = [f for f in folders if f == mailbox or f in names]
+                except Exception as le:
+                    logger.debug("[%s] IMAP LIST failed: %s", route_name, le)
+            scan_cache[mailbox] = folders
+
+        # Anchor the search with SINCE (IMAP dates have day granularity, so back up one
+        # day) and keep the broad unanchored criteria as a late fallback for servers
+        # that mishandle the narrow form. The token no longer travels in the body, so
+        # the second OR arm matches the X-E2E-Token header instead — that keeps a live
+        # fallback against relays that rewrite the Subject line
+        since = (datetime.fromtimestamp(start_ts) - timedelta(days=1)).date()
+        criteria = ['SINCE', since, 'OR', ['HEADER', 'Subject', subject_token], ['HEADER', 'X-E2E-Token', subject_token]]
+        broad_criteria = ['OR', ['SUBJECT', subject_token], ['HEADER', 'X-E2E-Token', subject_token]]
+
+        # Prefer IMAP IDLE (RFC 2177): block on the socket until the server pushes new-mail
+        # notifications instead of burning a SEARCH round-trip every poll tick; can be
+        # disabled via exporter.use_idle for servers with flaky IDLE implementations
+        use_idle = exporter.use_idle and client.has_capability("IDLE")
+
+        # On Gmail, X-GM-RAW search hits Gmail's native index; newer_than bounds the
+        # server-side scan so All Mail searches stay cheap even on huge mailboxes
+        use_gmail_search = is_gmail and client.has_capability("X-GM-EXT-1")
+        gmail_query = f'newer_than:1d subject:"{subject_token}"'
 
         while True:
+            # Close to the deadline, retry with the unanchored criteria in case the
+            # narrow search missed on this server
+            near_timeout = time.monotonic() > (deadline - 2 * poll_s)
+            active_criteria = broad_criteria if near_timeout else criteria
+
             found_msgs = []
             found_folder = None
             for f in folders:
+                if f != selected:
+                    try:
+                        client.select_folder(f, readonly=True)
+                        selected = f
+                    except Exception as sel_e:
+                        logger.debug("[%s] IMAP select folder '%s' failed: %s", route_name, f, sel_e)
+                        continue
                 try:
-                    client.select_folder(f)
-                except Exception as sel_e:
-                    logger.debug(f"[{route_name}] IMAP select folder '{f}' failed: {sel_e}")
-                    continue
-                try:
-                    msgs = client.search(criteria)
+                    if use_gmail_search:
+                        msgs = client.gmail_search(gmail_query)
+                    else:
+                        msgs = client.search(active_criteria)
                 except Exception as se:
-                    logger.debug(f"[{route_name}] IMAP search error in '{f}': {se}")
+                    logger.debug("[%s] IMAP search error in '%s': %s", route_name, f, se)
+                    # If the raw Gmail search misbehaves, drop to the generic criteria
+                    use_gmail_search = False
                     msgs = []
                 if msgs:
                     found_msgs = msgs
@@ -64,20 +207,23 @@ def imap_wait_receive(route_name: str, dst_key: str, subject_token: str, config_
                     break
 
             if found_msgs:
-                g_recv_ok.labels(route=route_name, **{"from": "?", "to": dst_key}).set(1)
-                g_last_recv.labels(route=route_name, **{"from": "?", "to": dst_key}).set(time.time())
-                g_roundtrip.labels(route=route_name, **{"from": "?", "to": dst_key}).set(time.time() - start_ts)
-                if bool(config_exporter.get("delete_testmail_after_verify", True)):
+                recv_ok.set(1)
+                last_recv.set(time.time())
+                roundtrip.set(time.time() - start_ts)
+                if exporter.delete_testmail_after_verify:
                     try:
+                        # Upgrade the found folder to read-write only now; MOVE, \Deleted
+                        # and EXPUNGE are all rejected on an EXAMINEd mailbox
+                        client.select_folder(found_folder, readonly=False)
                         # Try provider-specific safe delete: Gmail prefers moving to Trash over \Deleted/EXPUNGE
-                        if "gmail.com" in host_lc or host_lc.endswith("googlemail.com"):
+                        if is_gmail:
                             trash_candidates = ["[Gmail]/Trash", "[Google Mail]/Trash"]
                             moved = False
                             for trash in trash_candidates:
                                 try:
                                     # IMAPClient provides .move(); older code used a non-existent .move_messages
                                     client.move(found_msgs, trash)
-                                    logger.debug(f"[{route_name}] moved {len(found_msgs)} msg(s) from '{found_folder}' to '{trash}'")
+                                    logger.debug("[%s] moved %d msg(s) from '%s' to '%s'", route_name, len(found_msgs), found_folder, trash)
                                     moved = True
                                     break
                                 except AttributeError:
@@ -86,13 +232,13 @@ def imap_wait_receive(route_name: str, dst_key: str, subject_token: str, config_
                                         client.copy(found_msgs, trash)
                                         client.add_flags(found_msgs, ["\\Deleted"])  # escape backslash
                                         client.expunge()
-                                        logger.debug(f"[{route_name}] copied {len(found_msgs)} msg(s) from '{found_folder}' to '{trash}' then deleted originals")
+                                        logger.debug("[%s] copied %d msg(s) from '%s' to '%s' then deleted originals", route_name, len(found_msgs), found_folder, trash)
                                         moved = True
                                         break
                                     except Exception as me2:
-                                        logger.debug(f"[{route_name}] copy+delete to '{trash}' failed: {me2}")
+                                        logger.debug("[%s] copy+delete to '%s' failed: %s", route_name, trash, me2)
                                 except Exception as me:
-                                    logger.debug(f"[{route_name}] move to '{trash}' failed: {me}")
+                                    logger.debug("[%s] move to '%s' failed: %s", route_name, trash, me)
                             if not moved:
                                 # Fallback to \Deleted + EXPUNGE if move didn't work
                                 client.add_flags(found_msgs, ["\\Deleted"])  # escape backslash
@@ -102,11 +248,47 @@ def imap_wait_receive(route_name: str, dst_key: str, subject_token: str, config_
                             client.add_flags(found_msgs, ["\\Deleted"])  # escape backslash
                             client.expunge()
                     except Exception as de:
-                        logger.debug(f"[{route_name}] delete/move failed in '{found_folder}': {de}")
+                        logger.debug("[%s] delete/move failed in '%s': %s", route_name, found_folder, de)
                 return {"ok": True, "count": len(found_msgs), "folder": found_folder}
 
-            if (time.time() - start_ts) > timeout_s:
-                g_recv_ok.labels(route=route_name, **{"from": "?", "to": dst_key}).set(0)
+            if time.monotonic() > deadline:
+                recv_ok.set(0)
                 return {"ok": False, "timeout": True}
 
-            time.sleep(poll_s)
+            # Absolute next-wake: if the folder scan already ate (part of) the poll
+            # interval, sleep only the remainder instead of a full extra interval
+            next_poll = max(next_poll + poll_s, time.monotonic())
+
+            if use_idle:
+                try:
+                    # Re-select the primary mailbox if the scan left another folder selected,
+                    # then wait for an EXISTS push or the poll interval as keepalive
+                    if selected != mailbox:
+                        client.select_folder(mailbox, readonly=True)
+                        selected = mailbox
+                    client.idle()
+                    client.idle_check(timeout=poll_s)
+                    client.idle_done()
+                except Exception as ie:
+                    logger.debug("[%s] IMAP IDLE failed, falling back to polling: %s", route_name, ie)
+                    use_idle = False
+                    # The session may still be inside IDLE, where every later SELECT and
+                    # SEARCH would fail; if it can't be brought back out, surface the
+                    # error (the outer handler then drops the connection instead of
+                    # pooling it) rather than burning the whole timeout on a dead session
+                    try:
+                        client.idle_done()
+                    except Exception:
+                        raise ie
+                    time.sleep(max(0.0, next_poll - time.monotonic()))
+            else:
+                time.sleep(max(0.0, next_poll - time.monotonic()))
+    except Exception:
+        # Connection state is suspect; drop it instead of returning it to the pool
+        healthy = False
+        raise
+    finally:
+        if healthy:
+            _return_imap(host, port, user, client)
+        else:
+            _shutdown_quietly(client)
@@ -5,7 +5,9 @@ DEBUG = os.environ.get("DEBUG", "false").lower() in ("1", "true", "yes")
 
 logger = logging.getLogger("mail-e2e-exporter")
 _handler = logging.StreamHandler()
-_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+# %(created).3f instead of %(asctime)s: skips localtime+strftime per record while keeping
+# a machine-parseable (epoch seconds) timestamp; matters under DEBUG log volume
+_handler.setFormatter(logging.Formatter("%(created).3f %(levelname)s %(name)s: %(message)s"))
 logger.handlers.clear()
 logger.addHandler(_handler)
 logger.setLevel(logging.DEBUG if DEBUG else logging.INFO)
@@ -1,12 +1,14 @@
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 
 from .logging_setup import logger
 from .config import APP_VERSION
 from .routes import router
 from .runner import start_background, stop_background
+from .imap_client import close_all_imap
+from .smtp_client import close_all_smtp
 
-app = FastAPI(title="Mail E2E Exporter", version=APP_VERSION)
+app = FastAPI(title="Mail E2E Exporter", version=APP_VERSION, default_response_class=ORJSONResponse)
 app.include_router(router)
 
 
@@ -17,9 +19,11 @@ async def on_startup():
 
 @app.on_event("shutdown")
 async def on_shutdown():
-    stop_background()
+    await stop_background()
+    close_all_imap()
+    await close_all_smtp()
 
 
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
-    return JSONResponse(status_code=exc.status_code, content=exc.detail if isinstance(exc.detail, dict) else {"error": str(exc.detail)})
+    return ORJSONResponse(status_code=exc.status_code, content=exc.detail if isinstance(exc.detail, dict) else {"error": str(exc.detail)})
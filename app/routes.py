@@ -1,29 +1,38 @@
+import asyncio
+import gzip
 import os
+import threading
 import time
-from typing import Dict, Any, List
+from typing import Dict, Any
 
 from fastapi import APIRouter, Depends, HTTPException, Request
-from fastapi.responses import PlainTextResponse, JSONResponse
+from fastapi.responses import PlainTextResponse, ORJSONResponse
 from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 
 from .auth import require_api_key, require_metrics_basic_auth
-from .metrics import registry, METRICS_PREFIX
-from .config import config, APP_VERSION, GIT_SHA, BUILD_DATE
+from .metrics import registry, METRICS_PREFIX, c_errors, g_last_error
+from .config import config, APP_VERSION, GIT_SHA, BUILD_DATE, CONFIG_PATH
 from .logging_setup import logger
 from .config import reload_config_if_changed
+from .runner import wake_runner
 
 router = APIRouter()
 
+# Exposed sample names are fixed after startup; build the prefixed string once instead
+# of per request
+_ERRORS_SAMPLE_NAME = f"{METRICS_PREFIX}test_errors_total"
+
 
 @router.get("/health", response_class=PlainTextResponse)
 async def health(_=Depends(require_api_key)):
     return "ok"
 
 
-@router.get("/info", response_class=JSONResponse)
+@router.get("/info", response_class=ORJSONResponse)
 async def info(_=Depends(require_api_key)):
+    # stat can block on slow volumes (e.g. network-mounted config); keep it off the loop
     try:
-        st = os.stat(os.environ.get("CONFIG_PATH", "/app/config.yaml"))
+        st = await asyncio.to_thread(os.stat, CONFIG_PATH)
         mtime_ns = st.st_mtime_ns
         size = st.st_size
     except FileNotFoundError:
@@ -37,7 +46,7 @@ async def info(_=Depends(require_api_key)):
             "build_date": BUILD_DATE,
         },
         "config": {
-            "has_config": os.path.exists(os.environ.get("CONFIG_PATH", "/app/config.yaml")),
+            "has_config": mtime_ns is not None,
             "mtime_ns": mtime_ns,
             "size": size,
             "tests": [t.get("name") for t in config.tests()],
@@ -45,10 +54,32 @@ async def info(_=Depends(require_api_key)):
     }
 
 
+# Rendered exposition cache: values only move once per check cycle, so repeated scrapes
+# (HA Prometheus pairs, federation) within the TTL reuse the same bytes. The gzipped
+# form is cached alongside the raw one — compresslevel=1 keeps the compression cost
+# well below the generate_latest cost it amortizes.
+_metrics_cache: tuple = (0.0, b"", b"")
+_metrics_cache_lock = threading.Lock()
+
+
 @router.get("/metrics", response_class=PlainTextResponse)
-async def metrics(_=Depends(require_metrics_basic_auth)):
-    output = generate_latest(registry)
-    return PlainTextResponse(content=output, media_type=CONTENT_TYPE_LATEST)
+async def metrics(request: Request, _=Depends(require_metrics_basic_auth)):
+    global _metrics_cache
+    ttl = config.exporter.metrics_cache_ttl_seconds
+    now = time.monotonic()
+    with _metrics_cache_lock:
+        ts, raw, gzipped = _metrics_cache
+        if not raw or ttl <= 0 or (now - ts) >= ttl:
+            raw = generate_latest(registry)
+            gzipped = gzip.compress(raw, compresslevel=1)
+            _metrics_cache = (now, raw, gzipped)
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        return PlainTextResponse(
+            content=gzipped,
+            media_type=CONTENT_TYPE_LATEST,
+            headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"},
+        )
+    return PlainTextResponse(content=raw, media_type=CONTENT_TYPE_LATEST)
 
 
 @router.get("/version", response_class=PlainTextResponse)
@@ -56,48 +87,52 @@ async def version_endpoint(_=Depends(require_api_key)):
     return APP_VERSION
 
 
-# Helpers to collect samples
-from prometheus_client.samples import Sample
-
-def _collect_metric_samples(name: str) -> List[Dict[str, Any]]:
-    m = registry._names_to_collectors.get(name)  # type: ignore[attr-defined]
-    if not m:
-        return []
-    res: List[Dict[str, Any]] = []
-    for metric in m.collect():
-        for s in metric.samples:
-            if isinstance(s, Sample):
-                labels = dict(s.labels)
-                res.append({"name": s.name, "labels": labels, "value": s.value})
-    return res
-
-
-@router.get("/errors", response_class=JSONResponse)
+@router.get("/errors", response_class=ORJSONResponse)
 async def errors_endpoint(_=Depends(require_api_key)):
-    errs = _collect_metric_samples(f"{METRICS_PREFIX}test_errors_total")
-    last = _collect_metric_samples(f"{METRICS_PREFIX}last_error_info")
-
-    def key_of(lbls: Dict[str, str]):
-        return f"{lbls.get('route')}|{lbls.get('from')}|{lbls.get('to')}"
-
-    def index_by_key(samples: List[Dict[str, Any]]):
-        d = {}
-        for s in samples:
-            d[key_of(s["labels"])] = s
-        return d
+    # The endpoint only reads two metrics, so iterate those collectors directly
+    # rather than collecting the whole registry and bucketing everything by name.
+    # The counter is keyed by (route, step) — keying by route alone would collapse
+    # the step dimension and hide one of the two samples; the last-error hash has
+    # route granularity and is attached to each of the route's entries.
+    idx_errs: Dict[tuple, Dict[str, Any]] = {}
+    for metric in c_errors.collect():
+        for s in metric.samples:
+            if s.name != _ERRORS_SAMPLE_NAME:  # skip the _created companion series
+                continue
+            idx_errs[(s.labels.get("route"), s.labels.get("step"))] = {"name": s.name, "labels": dict(s.labels), "value": s.value}
+    idx_last: Dict[Any, float] = {}
+    for metric in g_last_error.collect():
+        for s in metric.samples:
+            idx_last[s.labels.get("route")] = s.value
 
-    idx_errs = index_by_key(errs)
-    idx_last = index_by_key(last)
+    def entry(k):
+        e = idx_errs[k].copy()
+        e["last_hash"] = idx_last.get(k[0])
+        return e
 
+    # Emit in the stable config-declared route order (send before receive); series
+    # from routes that are no longer configured (e.g. after a reload) follow in
+    # collection order
     out = []
-    for k, v in idx_errs.items():
-        e = v.copy()
-        e["last_hash"] = idx_last.get(k, {}).get("value")
-        out.append(e)
+    seen = set()
+    for t in config.tests():
+        route = t.get("name") or f"{t.get('from')}->{t.get('to')}"
+        for step in ("send", "receive"):
+            k = (route, step)
+            if k in idx_errs and k not in seen:
+                seen.add(k)
+                out.append(entry(k))
+    for k in idx_errs:
+        if k not in seen:
+            out.append(entry(k))
     return out
 
 
-@router.post("/reload", response_class=JSONResponse)
+@router.post("/reload", response_class=ORJSONResponse)
 async def reload_config(_=Depends(require_api_key)):
-    changed = reload_config_if_changed(logger, force=True)
+    # Reload does stat + file read + YAML parse; run it on a worker thread
+    changed = await asyncio.to_thread(reload_config_if_changed, logger, True)
+    if changed:
+        # Start a cycle with the new config now instead of after the current sleep
+        wake_runner()
     return {"reloaded": changed}
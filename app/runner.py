@@ -1,12 +1,12 @@
 import asyncio
-import threading
+import secrets
 import time
-import uuid
-import hashlib
+import zlib
+from dataclasses import dataclass
 from typing import Dict, Any
 
 from .logging_setup import logger
-from .config import config, APP_VERSION, GIT_SHA, BUILD_DATE
+from .config import config, reload_config_if_changed, ExporterSettings, APP_VERSION, GIT_SHA, BUILD_DATE
 from .metrics import (
     g_test_info, g_cfg_delete, g_cfg_receive_timeout, g_cfg_receive_poll, g_cfg_check_interval,
     g_cfg_smtp_timeout, g_recv_attempted, g_recv_skipped, g_last_error, c_errors, g_build_info,
@@ -15,136 +15,251 @@ from .metrics import (
 from .smtp_client import smtp_send, SMTPUncertainError
 from .imap_client import imap_wait_receive
 
-_stop_event = threading.Event()
-_worker_thread: threading.Thread | None = None
+# The runner is a plain task on the app's event loop; blocking mail I/O already runs
+# via asyncio.to_thread, so a dedicated thread with its own loop bought nothing and made
+# shutdown and /reload wake-ups wait out the full inter-cycle sleep.
+_stop_event = asyncio.Event()
+_wake_event = asyncio.Event()
+_runner_task: asyncio.Task | None = None
 
 
-def _hash_error(info: Dict[str, Any]) -> int:
-    s = str(sorted(info.items())).encode()
-    return int(hashlib.md5(s).hexdigest(), 16) % (10**6)
+def _hash_error(route: str, src: str, dst: str, step: str, error: str) -> int:
+    # The gauge only needs a stable change-detection bucket, not a cryptographic digest;
+    # one f-string over the fixed field order replaces the old sort/repr of a dict, and
+    # crc32 is a fraction of the md5 cost this started out with
+    payload = f"{route}|{src}|{dst}|{step}|{error}".encode("utf-8", "replace")
+    return zlib.crc32(payload) % (10**6)
 
 
-async def _run_one_test(route_name: str, t: Dict[str, Any]):
-    exporter_cfg = config.data.get("exporter", {})
+# Bound metric children per (route, from, to): every .labels() call hashes the label
+# tuple and walks prometheus_client's locked child dict, so resolve each child once on
+# first sight of a route and reuse it across cycles
 
+
+@dataclass(slots=True)
+class _RouteMetrics:
+    route: str
+    test_info: Any
+    send_ok: Any
+    recv_ok: Any
+    roundtrip: Any
+    last_send: Any
+    last_recv: Any
+    recv_attempted: Any
+    recv_skipped: Any
+    send_uncertain: Any
+    last_error: Any
+    # Error-counter children are bound on first error, matching the pre-cache behavior
+    # where a step's series only exists once that step has actually failed
+    errors_send: Any = None
+    errors_recv: Any = None
+
+    def inc_send_error(self) -> None:
+        if self.errors_send is None:
+            self.errors_send = c_errors.labels(route=self.route, step="send")
+        self.errors_send.inc()
+
+    def inc_recv_error(self) -> None:
+        if self.errors_recv is None:
+            self.errors_recv = c_errors.labels(route=self.route, step="receive")
+        self.errors_recv.inc()
+
+
+_route_children: Dict[tuple, _RouteMetrics] = {}
+
+
+def _children_for(route_name: str, src: str, dst: str) -> _RouteMetrics:
+    key = (route_name, src, dst)
+    ch = _route_children.get(key)
+    if ch is None:
+        # Only the info metric carries the account mapping; everything else is
+        # route-labeled (see metrics.py)
+        ch = _RouteMetrics(
+            route=route_name,
+            test_info=g_test_info.labels(route=route_name, **{"from": src, "to": dst}),
+            send_ok=g_send_ok.labels(route=route_name),
+            recv_ok=g_recv_ok.labels(route=route_name),
+            roundtrip=g_roundtrip.labels(route=route_name),
+            last_send=g_last_send.labels(route=route_name),
+            last_recv=g_last_recv.labels(route=route_name),
+            recv_attempted=g_recv_attempted.labels(route=route_name),
+            recv_skipped=g_recv_skipped.labels(route=route_name),
+            send_uncertain=g_send_uncertain.labels(route=route_name),
+            last_error=g_last_error.labels(route=route_name),
+        )
+        _route_children[key] = ch
+    return ch
+
+
+async def _run_one_test(route_name: str, t: Dict[str, Any], exporter_cfg: ExporterSettings):
     src = t["from"]
     dst = t["to"]
-    token = uuid.uuid4().hex[:12]
-    subject = f"{exporter_cfg.get('subject_prefix', '[MAIL-E2E]')} {route_name} E2E-{token}"
-    body = f"Mail E2E test for route {route_name} token={token}"
+    # 6 random bytes -> exactly 12 hex chars; uuid4().hex[:12] drew 16 bytes and threw
+    # most of them away
+    token = secrets.token_hex(6)
+    subject = f"{exporter_cfg.subject_prefix} {route_name} E2E-{token}"
+    # The token travels in the Subject and the X-E2E-Token header; keeping the body
+    # invariant lets smtp_send reuse its cached message skeleton across cycles
+    body = f"Mail E2E test for route {route_name}"
 
     logger.info(f"[{route_name}] starting test from={src} to={dst}")
-    g_test_info.labels(route=route_name, **{"from": src, "to": dst}).set(1)
+    ch = _children_for(route_name, src, dst)
+    ch.test_info.set(1)
 
-    timeout_s = int(t.get("smtp_timeout_seconds", exporter_cfg.get("smtp_timeout_seconds", 60)))
+    timeout_s = int(t.get("smtp_timeout_seconds", exporter_cfg.smtp_timeout_seconds))
     g_cfg_smtp_timeout.set(timeout_s)
 
-    g_last_send.labels(route=route_name, **{"from": src, "to": dst}).set(time.time())
+    # Keep the send time in locals: the timestamp gauge is write-only for us, and the
+    # duration is measured on the monotonic clock so NTP steps can't skew it
+    send_mono = time.monotonic()
+    ch.last_send.set(time.time())
 
     try:
-        await smtp_send(route_name, src, dst, subject, body, timeout_s)
+        await smtp_send(route_name, src, dst, subject, body, token, timeout_s)
         send_ok = True
         logger.info(f"[{route_name}] SMTP send ok")
     except SMTPUncertainError as ue:
         send_ok = False
-        g_send_ok.labels(route=route_name, **{"from": src, "to": dst}).set(0)
-        g_send_uncertain.labels(route=route_name, **{"from": src, "to": dst}).set(1)
-        info = {"route": route_name, "from": src, "to": dst, "step": "send", "error": str(ue)}
-        g_last_error.labels(route=route_name, **{"from": src, "to": dst}).set(_hash_error(info))
-        c_errors.labels(route=route_name, **{"from": src, "to": dst}, step="send").inc()
+        ch.send_ok.set(0)
+        ch.send_uncertain.set(1)
+        ch.last_error.set(_hash_error(route_name, src, dst, "send", str(ue)))
+        ch.inc_send_error()
         logger.warning(f"[{route_name}] SMTP uncertain send: {ue}")
     except Exception as e:
         send_ok = False
-        g_send_ok.labels(route=route_name, **{"from": src, "to": dst}).set(0)
-        g_send_uncertain.labels(route=route_name, **{"from": src, "to": dst}).set(0)
-        info = {"route": route_name, "from": src, "to": dst, "step": "send", "error": str(e)}
-        g_last_error.labels(route=route_name, **{"from": src, "to": dst}).set(_hash_error(info))
-        c_errors.labels(route=route_name, **{"from": src, "to": dst}, step="send").inc()
+        ch.send_ok.set(0)
+        ch.send_uncertain.set(0)
+        ch.last_error.set(_hash_error(route_name, src, dst, "send", str(e)))
+        ch.inc_send_error()
         logger.error(f"[{route_name}] SMTP send failed: {e}")
 
     if not send_ok:
-        g_recv_skipped.labels(route=route_name, **{"from": src, "to": dst}).set(1)
-        if exporter_cfg.get("uncertain_probe_on_timeout", True):
+        ch.recv_skipped.set(1)
+        if exporter_cfg.uncertain_probe_on_timeout:
             logger.info(f"[{route_name}] probing mailbox due to uncertain/failed send")
-            probe_cfg = dict(exporter_cfg)
-            res = imap_wait_receive(route_name, dst, token, probe_cfg)
+            # The probe is a quick "did it land anyway?" check, not a full receive wait
+            res = await asyncio.to_thread(
+                imap_wait_receive, route_name, dst, token, exporter_cfg,
+                timeout_s=exporter_cfg.uncertain_probe_timeout_seconds,
+                poll_s=exporter_cfg.uncertain_probe_poll_seconds,
+            )
             if res.get("ok"):
-                g_recv_ok.labels(route=route_name, **{"from": src, "to": dst}).set(1)
-                g_last_recv.labels(route=route_name, **{"from": src, "to": dst}).set(time.time())
+                ch.recv_ok.set(1)
+                ch.last_recv.set(time.time())
                 logger.info(f"[{route_name}] probe receive ok (post-uncertain)")
         return
 
     logger.info(f"[{route_name}] waiting for receive token in mailbox")
-    g_recv_attempted.labels(route=route_name, **{"from": src, "to": dst}).set(1)
-    res = imap_wait_receive(route_name, dst, token, exporter_cfg)
+    ch.recv_attempted.set(1)
+    res = await asyncio.to_thread(imap_wait_receive, route_name, dst, token, exporter_cfg)
     if res.get("ok"):
-        end = time.time()
-        g_recv_ok.labels(route=route_name, **{"from": src, "to": dst}).set(1)
-        g_last_recv.labels(route=route_name, **{"from": src, "to": dst}).set(end)
-        g_roundtrip.labels(route=route_name, **{"from": src, "to": dst}).set(end - g_last_send.labels(route=route_name, **{"from": src, "to": dst})._value.get())
+        ch.recv_ok.set(1)
+        ch.last_recv.set(time.time())
+        ch.roundtrip.set(time.monotonic() - send_mono)
         folder = res.get("folder") or "(selected)"
         logger.info(f"[{route_name}] receive ok count={res.get('count')} folder={folder}")
     else:
-        info = {"route": route_name, "from": src, "to": dst, "step": "receive", "error": "timeout"}
-        g_last_error.labels(route=route_name, **{"from": src, "to": dst}).set(_hash_error(info))
-        c_errors.labels(route=route_name, **{"from": src, "to": dst}, step="receive").inc()
-        logger.warning(f"[{route_name}] receive timeout after {exporter_cfg.get('receive_timeout_seconds', 120)}s")
+        ch.last_error.set(_hash_error(route_name, src, dst, "receive", "timeout"))
+        ch.inc_recv_error()
+        logger.warning(f"[{route_name}] receive timeout after {exporter_cfg.receive_timeout_seconds}s")
+
+
+# Config generation whose values were last written to the g_cfg_* gauges; gauges keep
+# their value between writes, so rewriting unchanged settings every cycle is pure waste
+_cfg_applied_gen = -1
 
 
 async def _run_all_tests_once():
-    exporter_cfg = config.data.get("exporter", {})
-    g_cfg_delete.set(1 if exporter_cfg.get("delete_testmail_after_verify", True) else 0)
-    g_cfg_receive_timeout.set(int(exporter_cfg.get("receive_timeout_seconds", 120)))
-    g_cfg_receive_poll.set(int(exporter_cfg.get("receive_poll_seconds", 5)))
-    g_cfg_check_interval.set(int(exporter_cfg.get("check_interval_seconds", 300)))
+    global _cfg_applied_gen
+    exporter_cfg = config.exporter
+    if _cfg_applied_gen != config.generation:
+        g_cfg_delete.set(1 if exporter_cfg.delete_testmail_after_verify else 0)
+        g_cfg_receive_timeout.set(exporter_cfg.receive_timeout_seconds)
+        g_cfg_receive_poll.set(exporter_cfg.receive_poll_seconds)
+        g_cfg_check_interval.set(exporter_cfg.check_interval_seconds)
+        _cfg_applied_gen = config.generation
 
     tests = list(config.tests())
     logger.info(f"Starting test cycle: {len(tests)} test(s) configured")
 
+    # Blocking IMAP waits run on worker threads (asyncio.to_thread), so routes really do
+    # overlap; the semaphore caps how many are in flight at once
+    sem = asyncio.Semaphore(max(1, exporter_cfg.max_parallel_tests))
+
+    async def _bounded(route_name: str, t: Dict[str, Any]):
+        async with sem:
+            await _run_one_test(route_name, t, exporter_cfg)
+
     tasks = []
     for t in tests:
         route_name = t.get("name") or f"{t.get('from')}->{t.get('to')}"
         logger.info(f"[cycle] scheduling route '{route_name}' from={t.get('from')} to={t.get('to')}")
-        tasks.append(asyncio.create_task(_run_one_test(route_name, t)))
+        tasks.append(asyncio.create_task(_bounded(route_name, t)))
     if tasks:
         await asyncio.gather(*tasks, return_exceptions=True)
     logger.info("Test cycle finished")
 
 
-def _thread_entry():
+async def _run_forever():
     # set build_info once per process
     try:
         g_build_info.labels(version=APP_VERSION, revision=GIT_SHA, build_date=BUILD_DATE).set(1)
     except Exception:
         pass
 
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-
-    check_interval = int(config.data.get("exporter", {}).get("check_interval_seconds", 300))
+    check_interval = config.exporter.check_interval_seconds
     logger.info(f"Background runner loop started (check_interval_seconds={check_interval})")
 
     while not _stop_event.is_set():
+        # Fixed-rate cadence: the deadline is anchored at cycle start on the monotonic
+        # clock, so a slow cycle shortens the following sleep instead of drifting the
+        # schedule by its own duration
+        cycle_start = time.monotonic()
+        # Consume the wake before the reload check, not before the sleep: a wake set
+        # while a cycle is still running (e.g. /reload mid-cycle) must survive until
+        # the sleep below and end it immediately
+        _wake_event.clear()
         try:
-            loop.run_until_complete(_run_all_tests_once())
+            # One stat per cycle; only reparses when the file fingerprint moved
+            await asyncio.to_thread(reload_config_if_changed, logger)
+            await _run_all_tests_once()
         except Exception as e:
             logger.exception(f"test loop failure: {e}")
         finally:
-            check_interval = int(config.data.get("exporter", {}).get("check_interval_seconds", 300))
-            logger.info(f"Sleeping until next cycle: {check_interval}s")
-            _stop_event.wait(check_interval)
+            check_interval = config.exporter.check_interval_seconds
+            remaining = max(0.0, (cycle_start + check_interval) - time.monotonic())
+            logger.info(f"Sleeping until next cycle: {remaining:.1f}s")
+            # The wake event ends the sleep early: /reload sets it after swapping the
+            # config, and stop_background sets it alongside the stop event
+            try:
+                await asyncio.wait_for(_wake_event.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                pass
 
-    loop.close()
+
+def wake_runner():
+    """Cut the inter-cycle sleep short (e.g. after a forced config reload)."""
+    _wake_event.set()
 
 
 def start_background():
-    global _worker_thread
-    if _worker_thread and _worker_thread.is_alive():
+    global _runner_task
+    if _runner_task and not _runner_task.done():
         return
     logger.info(f"Starting Mail E2E Exporter v{APP_VERSION} rev={GIT_SHA or 'n/a'} build_date={BUILD_DATE or 'n/a'}")
-    _worker_thread = threading.Thread(target=_thread_entry, name="mail-e2e-runner", daemon=True)
-    _worker_thread.start()
+    _stop_event.clear()
+    _runner_task = asyncio.get_running_loop().create_task(_run_forever(), name="mail-e2e-runner")
 
 
-def stop_background():
+async def stop_background():
     _stop_event.set()
+    _wake_event.set()
+    task = _runner_task
+    if task is not None and not task.done():
+        # Don't wait out a cycle that is mid-flight; blocking mail I/O finishes on its
+        # worker thread while the app shuts down
+        task.cancel()
+        try:
+            await task
+        except (asyncio.CancelledError, Exception):
+            pass
@@ -1,9 +1,11 @@
 import asyncio
 import random
+import ssl
 import time
 from typing import Any, Dict
 from email.message import EmailMessage
 import aiosmtplib
+from aiosmtplib import errors as smtp_errors
 
 from .logging_setup import logger
 from .config import config
@@ -15,25 +17,144 @@ class SMTPUncertainError(Exception):
     pass
 
 
-def _expand_env_value(val: Any):
-    import os
-    if isinstance(val, str):
-        return os.path.expandvars(val)
-    if isinstance(val, dict):
-        return {k: _expand_env_value(v) for k, v in val.items()}
-    if isinstance(val, list):
-        return [_expand_env_value(v) for v in val]
-    return val
+# Prebuilt so the except clause doesn't assemble the tuple on every attempt
+_SMTP_RETRY_EXC = (smtp_errors.SMTPTimeoutError, smtp_errors.SMTPServerDisconnected, TimeoutError)
+
+# One shared TLS context for all SMTP and IMAP connections: the CA bundle is parsed once
+# per process instead of per connection, and OpenSSL session reuse lets reconnects to the
+# same server skip the full handshake
+_SSL_CTX = ssl.create_default_context()
+
+# Routes sharing one SMTP account would otherwise all connect at once at cycle start,
+# which is what triggers most 4xx greeting/rate-limit replies; cap concurrent sessions
+# per (host, username). The cycle-wide cap is exporter.max_parallel_tests in runner.py.
+_ACCOUNT_SEM_LIMIT = 2
+_account_sems: Dict[tuple, asyncio.Semaphore] = {}
+
+
+def _sem_for(host: str, username: str) -> asyncio.Semaphore:
+    key = (host, username)
+    sem = _account_sems.get(key)
+    if sem is None:
+        sem = _account_sems[key] = asyncio.Semaphore(_ACCOUNT_SEM_LIMIT)
+    return sem
+
+
+# Pooled SMTP sessions keyed by (host, port, username): TCP + STARTTLS + AUTH cost a few
+# hundred ms per send, paid once per session instead of once per route per cycle. SMTP
+# sessions are strictly sequential, so a per-key lock serializes transactions on a
+# shared session.
+_SMTP_POOL: Dict[tuple, aiosmtplib.SMTP] = {}
+_SMTP_POOL_LOCKS: Dict[tuple, asyncio.Lock] = {}
+
+
+def _smtp_lock_for(key: tuple) -> asyncio.Lock:
+    lock = _SMTP_POOL_LOCKS.get(key)
+    if lock is None:
+        lock = _SMTP_POOL_LOCKS[key] = asyncio.Lock()
+    return lock
+
+
+def _close_quietly(client: aiosmtplib.SMTP) -> None:
+    try:
+        client.close()
+    except Exception:
+        pass
+
+
+def _new_smtp(host: str, port: int, starttls: bool, use_tls: bool, username: str, password: str, timeout_s: int) -> aiosmtplib.SMTP:
+    return aiosmtplib.SMTP(
+        hostname=host,
+        port=port,
+        username=username,
+        password=password,
+        start_tls=starttls,
+        use_tls=use_tls,
+        timeout=timeout_s,
+        tls_context=_SSL_CTX,
+    )
+
+
+async def _pooled_send(message: EmailMessage, host: str, port: int, starttls: bool, use_tls: bool, username: str, password: str, timeout_s: int) -> None:
+    key = (host, port, username)
+    async with _smtp_lock_for(key):
+        client = _SMTP_POOL.get(key)
+        reused = client is not None
+        if client is None:
+            client = _new_smtp(host, port, starttls, use_tls, username, password, timeout_s)
+        try:
+            if not client.is_connected:
+                await client.connect()
+            await client.send_message(message)
+        except smtp_errors.SMTPServerDisconnected:
+            # Pooled sessions go stale when the server idle-times them out between
+            # cycles; reconnect once on a fresh client before surfacing the error
+            _SMTP_POOL.pop(key, None)
+            _close_quietly(client)
+            if not reused:
+                raise
+            client = _new_smtp(host, port, starttls, use_tls, username, password, timeout_s)
+            try:
+                await client.connect()
+                await client.send_message(message)
+            except Exception:
+                _close_quietly(client)
+                raise
+        except Exception:
+            # The client won't be pooled, so close it: a 4xx/5xx reply or auth failure
+            # would otherwise abandon a live TLS connection per retry attempt
+            _SMTP_POOL.pop(key, None)
+            _close_quietly(client)
+            raise
+        _SMTP_POOL[key] = client
+
+
+async def close_all_smtp() -> None:
+    """QUIT and drop every pooled SMTP session (app shutdown)."""
+    clients = list(_SMTP_POOL.values())
+    _SMTP_POOL.clear()
+    for client in clients:
+        try:
+            await client.quit()
+        except Exception:
+            _close_quietly(client)
+
+
+# Cached message skeletons keyed by (route, src, dst): header setup and the
+# quoted-printable content pass run once per route, later sends only patch the Subject
+# and token header. Keyed by route (not just the account pair) so two routes sharing an
+# account pair never mutate one message concurrently — the runner schedules at most one
+# task per route per cycle.
+_MSG_CACHE: Dict[tuple, EmailMessage] = {}
+
+
+def _message_for(route_name: str, src_key: str, dst_key: str, from_addr: str, to_addr: str, subject: str, body: str, token: str) -> EmailMessage:
+    key = (route_name, src_key, dst_key)
+    msg = _MSG_CACHE.get(key)
+    if msg is None or msg["From"] != from_addr or msg["To"] != to_addr:
+        msg = EmailMessage()
+        msg["From"] = from_addr
+        msg["To"] = to_addr
+        msg["Subject"] = subject
+        msg["X-E2E-Token"] = token
+        # Force safe textual encoding: UTF-8 + quoted-printable so '=' is encoded as '=3D' and cannot be misinterpreted
+        msg.set_content(body, subtype="plain", charset="utf-8", cte="quoted-printable")
+        _MSG_CACHE[key] = msg
+    else:
+        msg.replace_header("Subject", subject)
+        msg.replace_header("X-E2E-Token", token)
+    return msg
 
 
 def _get_account(key: str) -> Dict[str, Any]:
-    accs = config.data.get("accounts", {})
+    # Env expansion already happened at config load; this is a plain dict lookup
+    accs = config.accounts_expanded
     if key not in accs:
         raise ValueError(f"unknown account: {key}")
-    return _expand_env_value(accs[key])
+    return accs[key]
 
 
-async def smtp_send(route_name: str, src_key: str, dst_key: str, subject: str, body: str, timeout_s: int) -> Dict[str, Any]:
+async def smtp_send(route_name: str, src_key: str, dst_key: str, subject: str, body: str, token: str, timeout_s: int) -> Dict[str, Any]:
     src = _get_account(src_key)
     dst = _get_account(dst_key)
 
@@ -54,60 +175,55 @@ async def smtp_send(route_name: str, src_key: str, dst_key: str, subject: str, b
     if password is None or password == "":
         raise Exception(f"SMTP password empty for account '{src_key}' user={username} host={host}.")
 
-    message = EmailMessage()
-    message["From"] = username
-    message["To"] = to_addr
-    message["Subject"] = subject
-    # Force safe textual encoding: UTF-8 + quoted-printable so '=' is encoded as '=3D' and cannot be misinterpreted
-    message.set_content(body, subtype="plain", charset="utf-8", cte="quoted-printable")
+    message = _message_for(route_name, src_key, dst_key, username, to_addr, subject, body, token)
+
+    g_last_send.labels(route=route_name).set(time.time())
 
-    g_last_send.labels(route=route_name, **{"from": src_key, "to": dst_key}).set(time.time())
+    exporter = config.exporter
+    backoffs = exporter.smtp_retry_backoffs or (3.0,)
 
-    from aiosmtplib import errors as smtp_errors
+    def _backoff_for(attempt: int) -> float:
+        # Schedule entry for this attempt (last entry repeats), jittered so retries
+        # from routes sharing an account don't land in lockstep
+        return backoffs[min(attempt - 1, len(backoffs) - 1)] + random.random() * 1.5
 
     attempts = 0
-    max_attempts = 3
-    while attempts < max_attempts:
-        attempts += 1
-        try:
-            await aiosmtplib.send(
-                message,
-                hostname=host,
-                port=port,
-                start_tls=starttls,
-                use_tls=use_tls,
-                username=username,
-                password=password,
-                timeout=timeout_s,
-            )
-            g_send_ok.labels(route=route_name, **{"from": src_key, "to": dst_key}).set(1)
-            g_send_uncertain.labels(route=route_name, **{"from": src_key, "to": dst_key}).set(0)
-            return {"ok": True}
-        except smtp_errors.SMTPResponseException as e:
-            code = int(getattr(e, "code", 0) or 0)
-            if 400 <= code < 500:
-                c_rate_limited.labels(route=route_name, **{"from": src_key, "to": dst_key}, code=str(code)).inc()
+    max_attempts = max(1, exporter.smtp_max_attempts)
+    # Hold the per-account slot across retries too, so backoff sleeps keep throttling
+    # an account that is already answering 4xx
+    async with _sem_for(host, username):
+        while attempts < max_attempts:
+            attempts += 1
+            try:
+                await _pooled_send(message, host, port, starttls, use_tls, username, password, timeout_s)
+                g_send_ok.labels(route=route_name).set(1)
+                g_send_uncertain.labels(route=route_name).set(0)
+                return {"ok": True}
+            except smtp_errors.SMTPResponseException as e:
+                code = int(getattr(e, "code", 0) or 0)
+                if 400 <= code < 500:
+                    c_rate_limited.labels(route=route_name, code=str(code)).inc()
+                    if attempts < max_attempts:
+                        backoff = _backoff_for(attempts)
+                        logger.warning(f"[{route_name}] SMTP {code} temp failure attempt {attempts}, retrying in {backoff:.1f}s")
+                        await asyncio.sleep(backoff)
+                        continue
+                g_send_ok.labels(route=route_name).set(0)
+                raise
+            except _SMTP_RETRY_EXC as e:
                 if attempts < max_attempts:
-                    backoff = min(30, 3 * (2 ** (attempts - 1))) + random.uniform(0, 1.5)
-                    logger.warning(f"[{route_name}] SMTP {code} temp failure attempt {attempts}, retrying in {backoff:.1f}s")
+                    backoff = _backoff_for(attempts)
+                    logger.warning(f"[{route_name}] SMTP timeout/disconnect attempt {attempts}, retrying in {backoff:.1f}s...")
                     await asyncio.sleep(backoff)
                     continue
-            g_send_ok.labels(route=route_name, **{"from": src_key, "to": dst_key}).set(0)
-            raise
-        except (smtp_errors.SMTPTimeoutError, smtp_errors.SMTPServerDisconnected, TimeoutError) as e:  # type: ignore[attr-defined]
-            if attempts < max_attempts:
-                backoff = min(5, max(2, timeout_s // 20))
-                logger.warning(f"[{route_name}] SMTP timeout/disconnect attempt {attempts}, retrying in {backoff}s...")
-                await asyncio.sleep(backoff)
-                continue
-            g_send_ok.labels(route=route_name, **{"from": src_key, "to": dst_key}).set(0)
-            g_send_uncertain.labels(route=route_name, **{"from": src_key, "to": dst_key}).set(1)
-            raise SMTPUncertainError(str(e))
-        except Exception:
-            g_send_ok.labels(route=route_name, **{"from": src_key, "to": dst_key}).set(0)
-            g_send_uncertain.labels(route=route_name, **{"from": src_key, "to": dst_key}).set(0)
-            raise
+                g_send_ok.labels(route=route_name).set(0)
+                g_send_uncertain.labels(route=route_name).set(1)
+                raise SMTPUncertainError(str(e))
+            except Exception:
+                g_send_ok.labels(route=route_name).set(0)
+                g_send_uncertain.labels(route=route_name).set(0)
+                raise
 
     # Should not reach here
-    g_send_ok.labels(route=route_name, **{"from": src_key, "to": dst_key}).set(0)
+    g_send_ok.labels(route=route_name).set(0)
     return {"ok": False}